@@ -7,14 +7,20 @@
 
 import os
 import numpy as np
-import datetime
 import time
 import platform
 import threading
+import queue
+import shutil
+import subprocess
 from sys import gettrace
 import configparser
 
-if platform.system() == "Linux":
+# Evaluate once at import, rather than every time we need to know
+_IS_LINUX = platform.system() == "Linux"
+_IS_WINDOWS = platform.system() == "Windows"
+
+if _IS_LINUX:
     import RPi.GPIO as GPIO
 
 os.environ["OPENCV_LOG_LEVEL"] = "FATAL"  # Suppress warnings that occur when camera id not found. This statement must occur before importing cv2
@@ -42,7 +48,9 @@ import cv2
 
 configParser = configparser.RawConfigParser()
 configFilePath = r'config.txt'
-configParser.read(configFilePath)
+if not configParser.read(configFilePath):
+    # Config file is optional, but say so, in case it was meant to be there (e.g. program started from wrong folder)
+    print(f"No {configFilePath} found in {os.getcwd()}, will use default settings")
 
 DATA_FOLDER = configParser.get('options', 'DATA_FOLDER', fallback='')
 
@@ -52,7 +60,7 @@ if not (DATA_FOLDER.endswith("/") or DATA_FOLDER.endswith("\\")):
 FRAME_RATE_PER_SECOND = configParser.getint('options', 'FRAME_RATE_PER_SECOND', fallback=10)
 HEIGHT = configParser.getint('options', 'HEIGHT', fallback=480)
 WIDTH = configParser.getint('options', 'WIDTH', fallback=640)
-if platform.system() == "Linux":
+if _IS_LINUX:
     FOURCC = configParser.get('options', 'FOURCC', fallback='h264')
 else:
     # Note: h264 codec comes with OpenCV on Linux/Pi, but not Windows. Will default to using mp4v on
@@ -60,171 +68,466 @@ else:
     # but it has poor compression ratio, and doesn't always install anyway.
     FOURCC = configParser.get('options', 'FOURCC', fallback='mp4v')
 
+# Optionally record via a GStreamer pipeline with a tunable x264 encoder, which has less overhead
+# than OpenCV's built-in writer. Off by default, since it saves .mkv instead of .avi files.
+# Falls back to FOURCC codec above if the pipeline can't be opened.
+USE_GSTREAMER = configParser.getboolean('options', 'USE_GSTREAMER', fallback=False)
+_gstreamer_warned = False
+
+# Alternatively, pipe raw frames to an ffmpeg process. This is tried before GStreamer, and lets
+# the Pi4's hardware encoder (h264_v4l2m2m) be used. Pi5 has no hardware encoder, so default is libx264.
+USE_FFMPEG = configParser.getboolean('options', 'USE_FFMPEG', fallback=False)
+FFMPEG_CODEC = configParser.get('options', 'FFMPEG_CODEC', fallback='libx264')
+if USE_FFMPEG and shutil.which("ffmpeg") is None:
+    print("ffmpeg not found, will use OpenCV video writer instead")
+    USE_FFMPEG = False
+
+# Pixel format to request from webcams, e.g. MJPG. Blank means use the camera's default (usually
+# uncompressed YUYV).
+CAMERA_FOURCC = configParser.get('options', 'CAMERA_FOURCC', fallback='')
+
+# If 0, videos are recorded in grayscale. Conversion is done on the encoder thread, and gives the
+# encoder a third as many bytes to read per frame. Display still shows camera's original frames.
+RECORD_COLOR = configParser.getboolean('options', 'RECORD_COLOR', fallback=True)
+
 MAX_INTERVAL_IN_TTL_BURST = configParser.getfloat('options', 'MAX_INTERVAL_IN_TTL_BURST', fallback=1.5)
 NUM_TTL_PULSES_TO_START_SESSION = configParser.getint('options', 'NUM_TTL_PULSES_TO_START_SESSION', fallback=2)
 NUM_TTL_PULSES_TO_STOP_SESSION = configParser.getint('options', 'NUM_TTL_PULSES_TO_STOP_SESSION', fallback=3)
 
-FONT_SCALE = HEIGHT / 480
+# Same as above, but in integer nanoseconds, for comparison against time.monotonic_ns() intervals
+MAX_INTERVAL_IN_TTL_BURST_NS = int(MAX_INTERVAL_IN_TTL_BURST * 1_000_000_000)
 
+# GPIO rising edges closer together than this (1ms) are switch bounces, and are ignored
+GPIO_DEBOUNCE_NS = 1_000_000
 
-import datetime
+# Stop bursts are ignored in the first 5 seconds of a session, so that they can't be confused with the start burst
+MIN_SESSION_BEFORE_STOP_NS = 5_000_000_000
 
+# Time between recorded frames. Some webcams ignore requests for low frame rates, so frames that arrive
+# much sooner than this after the previous one are skipped.
+FRAME_PERIOD_NS = 1_000_000_000 // FRAME_RATE_PER_SECOND
+
+# CPU core to pin the camera capture threads to on Linux, leaving the other cores for video compression.
+# -1 (default) leaves scheduling entirely to the operating system.
+CAPTURE_CPU = configParser.getint('options', 'CAPTURE_CPU', fallback=-1)
+
+# Real-time (SCHED_FIFO) priority, 1-99, for camera capture threads and the GPIO callback thread on Linux,
+# so that frame and TTL timestamps are not delayed by video compression. 0 (default) disables this.
+REALTIME_PRIORITY = configParser.getint('options', 'REALTIME_PRIORITY', fallback=0)
+
+FONT_SCALE = HEIGHT / 480
+
+# Overlay positions and sizes only depend on FONT_SCALE, so work them out once here rather than on every frame
+LABEL_POSITION = (int(10 * FONT_SCALE), int(30 * FONT_SCALE))  # Bottom left of camera number or status text
+LABEL_THICKNESS = round(FONT_SCALE + 0.5)
+DOT_RADIUS = int(8 * FONT_SCALE)
+RECORD_DOT_POSITION = (int(20 * FONT_SCALE), int(50 * FONT_SCALE))  # Red dot when recording, dark red when start pending
+GPIO_DOT_POSITION = (int(20 * FONT_SCALE), int(70 * FONT_SCALE))    # Blue dot when TTL received
 
-def get_date_string():
-    now = datetime.datetime.now()
-    year = '{:04d}'.format(now.year)
-    month = '{:02d}'.format(now.month)
-    day = '{:02d}'.format(now.day)
-    hour = '{:02d}'.format(now.hour)
-    minute = '{:02d}'.format(now.minute)
-    day_month_year = '{}-{}-{}_{}{}'.format(year, month, day, hour, minute)
 
-    return day_month_year
+# Most recent result of get_date_string(), and the minute (counted from 1970) that it was generated in
+_date_string_cache = [-1, ""]
 
 
-def make_blank_frame(txt):
-    tmp = np.zeros((HEIGHT, WIDTH, 3), dtype="uint8")
-    cv2.putText(tmp, txt, (int(10 * FONT_SCALE), int(30 * FONT_SCALE)), cv2.FONT_HERSHEY_SIMPLEX,
+def get_date_string():
+    # Returns string of form YYYY-MM-DD_HHMM. Since this only changes once per minute,
+    # reuse the previous string unless the minute has rolled over.
+    now = time.time()
+    minute = int(now) // 60
+    if minute != _date_string_cache[0]:
+        _date_string_cache[1] = time.strftime("%Y-%m-%d_%H%M", time.localtime(now))
+        _date_string_cache[0] = minute
+
+    return _date_string_cache[1]
+
+
+# Black frame shared by all callers of make_blank_frame(). It is marked read-only, so that
+# nobody can accidentally draw on it. Frames that need a text label get their own copy.
+_BLANK_BASE = np.zeros((HEIGHT, WIDTH, 3), dtype="uint8")
+_BLANK_BASE.flags.writeable = False
+
+
+# If out is provided (and is the right size), the frame is drawn into it instead of a newly allocated array.
+def make_blank_frame(txt, out=None):
+    if not txt:
+        # Nothing to draw, so share the read-only base frame rather than allocating a new one
+        return _BLANK_BASE
+    if out is not None and out.shape == _BLANK_BASE.shape:
+        tmp = out
+        np.copyto(tmp, _BLANK_BASE)
+    else:
+        tmp = _BLANK_BASE.copy()
+    cv2.putText(tmp, txt, LABEL_POSITION, cv2.FONT_HERSHEY_SIMPLEX,
                 FONT_SCALE, (255, 255, 255),
-                round(FONT_SCALE + 0.5))   # Line thickness
+                LABEL_THICKNESS)
     return tmp
 
 
-class closer(threading.Thread):
-    def __init__(self, cam_obj):
-        threading.Thread.__init__(self)
-        self.cam_obj = cam_obj
+class FFmpegWriter:
+
+    # Stand-in for cv2.VideoWriter, providing the methods that CamObj uses. Raw BGR (or grayscale, if
+    # RECORD_COLOR is 0) frames are piped to an ffmpeg process, which does the encoding.
 
-    def run(self):
+    def __init__(self, filename, fps, resolution):
+        cmd = ["ffmpeg", "-loglevel", "error", "-y",
+               "-f", "rawvideo", "-pix_fmt", "bgr24" if RECORD_COLOR else "gray", "-s", f"{resolution[0]}x{resolution[1]}",
+               "-r", str(fps), "-i", "-",
+               "-c:v", FFMPEG_CODEC, "-pix_fmt", "yuv420p",
+               # No B-frames, so encoder never holds frames back waiting for later ones. Keyframe every second,
+               # so that a file from an interrupted recording can be played up to within a second of the end.
+               "-bf", "0", "-g", str(int(fps))]
+        if FFMPEG_CODEC == "libx264":
+            cmd += ["-preset", "ultrafast", "-tune", "zerolatency"]
+        cmd += ["-b:v", "2M", filename]
+
+        # Unbuffered, so that each frame goes straight from its array into the pipe without another copy
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, bufsize=0)
+
+        # ffmpeg does the actual compression, so it needs the same treatment as the encoder thread. It
+        # only inherits that if started from the encoder thread, which isn't the case for the first
+        # recording. Its encoding threads are created once the first frame arrives, and inherit these
+        # settings from its main thread.
+        if _IS_LINUX:
+            try:
+                if CAPTURE_CPU >= 0:
+                    os.sched_setaffinity(self.proc.pid, set(range(os.cpu_count())) - {CAPTURE_CPU})
+                if REALTIME_PRIORITY > 0:
+                    os.setpriority(os.PRIO_PROCESS, self.proc.pid, 5)
+            except OSError:
+                pass
+            # In case it was started from a real-time thread
+            set_normal_scheduling(self.proc.pid)
+
+    def isOpened(self):
+        return self.proc.poll() is None
+
+    def write(self, frame):
+        # Numpy array supports the buffer protocol, so no need for tobytes(). Pipe is unbuffered, so
+        # this goes straight to write() system calls on the pipe.
+        write_all(self.proc.stdin, frame)
+
+    def release(self):
+        # Closing pipe tells ffmpeg that there are no more frames. Then wait for it to finish writing file.
         try:
-            self.cam_obj.stop_record_thread()
-        except:
+            self.proc.stdin.close()
+        except OSError:
             pass
+        self.proc.wait()
 
 
 filename_log = DATA_FOLDER + get_date_string() + "_log.txt"
 
 
 try:
-    # Create text file for frame timestamps
+    # Create text file for log messages
     fid_log = open(filename_log, 'w')
     print("Logging events to file: \'" + filename_log + "\'")
 except:
+    fid_log = None
     print("Unable to create log file: \'" + filename_log + "\'.\n  Please make sure folder exists and that you have permission to write to it.")
 
 
+# Per-thread cache of the "YYYY-MM-DD HH:" part of log timestamps, which only changes once per hour.
+# printt() is called from several threads (main loop, GPIO callbacks, file-closing helpers), so each
+# thread keeps its own copy rather than sharing one that could change underneath it.
+_ts_cache = threading.local()
+
 # Writes text to both screen and log file. The log file helps us retrospectively figure out what happened when debugging.
 def printt(txt, omit_date_time=False, close_file=False):
+
     # Get the current date and time
     if not omit_date_time:
-        now = datetime.datetime.now()
-
-        s = now.strftime("%Y-%m-%d %H:%M:%S: ") + txt
+        now = int(time.time())
+
+        # Seconds since the start of the cached local hour
+        sec_in_hour = now - getattr(_ts_cache, 'hour_start', -3600)
+        if not 0 <= sec_in_hour < 3600:
+            # Hour has rolled over (or this thread has not logged before), so rebuild the prefix.
+            # Hour start is derived from local time, so that this also works in time zones
+            # whose offset from UTC is not a whole number of hours.
+            lt = time.localtime(now)
+            _ts_cache.hour_start = now - lt.tm_min * 60 - lt.tm_sec
+            _ts_cache.prefix = time.strftime("%Y-%m-%d %H:", lt)
+            sec_in_hour = now - _ts_cache.hour_start
+
+        s = "%s%02d:%02d: %s" % (_ts_cache.prefix, sec_in_hour // 60, sec_in_hour % 60, txt)
     else:
         s = txt
     print(s)
+    if fid_log is None:
+        return
     try:
         fid_log.write(s + "\n")
-        fid_log.flush()
         if close_file:
             fid_log.close()
-    except:
+        else:
+            # Flush every line, so that the log is complete if we crash. Messages are rare (a few per
+            # recording), so this costs nothing noticeable.
+            fid_log.flush()
+    except (OSError, ValueError):
+        # ValueError if file has already been closed
         pass
 
 
 
+# Pins the calling thread to the specified set of CPU cores, and optionally changes its niceness.
+# Only works on Linux. Raising priority (negative nice_increment) requires CAP_SYS_NICE, e.g. running
+# as root. If that is not available we print a message and carry on with normal priority.
+def set_thread_affinity(cpus, nice_increment=0):
+    if not _IS_LINUX:
+        return
+
+    try:
+        # On Linux, pid 0 refers to the calling thread only, not the whole process.
+        os.sched_setaffinity(0, cpus)
+    except (OSError, ValueError) as e:
+        printt(f"Unable to set CPU affinity to cores {sorted(cpus)}: {e}")
+
+    if nice_increment != 0:
+        try:
+            # Also per-thread on Linux
+            os.nice(nice_increment)
+        except OSError as e:
+            printt(f"Unable to change thread priority by {nice_increment}: {e}")
+
+
+def set_thread_realtime(priority):
+    if not _IS_LINUX or priority <= 0:
+        return
+
+    try:
+        # SCHED_FIFO threads run whenever they are ready, ahead of all normal threads. Like
+        # sched_setaffinity, pid 0 refers to the calling thread only. Requires root privileges.
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except (OSError, ValueError, AttributeError) as e:
+        printt(f"Unable to set real-time priority {priority}: {e}")
+
+
+# Threads and child processes inherit their scheduling policy from whichever thread created them. Anything
+# started (directly or indirectly) from a real-time thread would therefore also run at real-time priority,
+# where e.g. video compression could starve capture. This puts the calling thread (or process pid) back
+# to normal scheduling.
+def set_normal_scheduling(pid=0):
+    if not _IS_LINUX or REALTIME_PRIORITY <= 0:
+        return
+
+    try:
+        os.sched_setscheduler(pid, os.SCHED_OTHER, os.sched_param(0))
+    except (OSError, AttributeError) as e:
+        printt(f"Unable to reset scheduling policy: {e}")
+
+
+# Tracks whether the GPIO library's callback thread has been given real-time priority yet
+_gpio_thread_state = threading.local()
+
+
+# Bound once, so the GPIO callback and per-frame code skip the attribute lookup on the time module
+_monotonic_ns = time.monotonic_ns
+
+
+# Writes all of data (bytes, or any contiguous buffer such as a frame) to an unbuffered file or pipe. A
+# single write() system call might not take everything (e.g. if interrupted by a signal), hence the loop.
+def write_all(fid, data):
+    n = 0
+    # Cast to flat bytes, so that lengths and slices count bytes rather than rows of a frame
+    with memoryview(data) as view, view.cast('B') as raw:
+        while n < len(raw):
+            n += fid.write(raw[n:])
+
+
+# Frame timestamps are accumulated in memory, and written to file every FLUSH_INTERVAL_SEC, or sooner
+# if this many bytes have built up
+TS_BUF_FLUSH_SIZE = 32768
+
+# How often the encoder thread writes buffered frame and TTL timestamps to file. This keeps disk I/O out
+# of the GPIO callback, while limiting how much would be lost if the program were to crash.
+FLUSH_INTERVAL_SEC = 1.0
+
+# Recording states. Transitions between these happen while holding CamObj.lock, but the slow work
+# (creating and closing files) is done outside the lock, while in the STARTING or STOPPING state.
+STATE_IDLE = 0
+STATE_STARTING = 1
+STATE_RECORDING = 2
+STATE_STOPPING = 3
+
+# Maximum number of frames that can be waiting for the encoder thread. If the encoder falls further
+# behind than this, new frames are dropped (and counted) rather than stalling capture. One second's
+# worth of frames rides out brief disk or encoder stalls. Free buffers are reused last-in, first-out,
+# so a buffer is only touched (and its memory only committed) once the encoder actually falls that far behind.
+ENCODE_QUEUE_SIZE = max(1, configParser.getint('options', 'ENCODE_BUFFER_FRAMES',
+                                               fallback=max(8, int(FRAME_RATE_PER_SECOND))))
+
+
 class CamObj:
-    cam = None   # this is the opencv camera object
-    id_num = -1  # ID number assigned by operating system. May be unpredictable.
-    order = -1  # User-friendly camera ID. Will usually be USB port position, and also position on screen
-    status = -1  # True if camera is operational and connected
-    frame = None  # Most recently obtained video frame. If camera lost connection, this will be a black frame with some text
-    filename = "Video.avi"
-    filename_timestamp = "Timestamp.txt"
-    filename_timestamp_TTL = "Timestamp_TTL.txt"
-
-    # Various file writer objects
-    Writer = None    # Writer for video file
-    fid = None       # Writer for timestamp file
-    fid_TTL = None   # Writer for TTL timestamp file
-
-    start_time = -1  # Timestamp when recording started.
-    IsRecording = False
-    GPIO_pin = -1    # Which GPIO pin corresponds to this camera? First low-high transition will start recording.
-
-    frame_num = -1   # Number of frames recorded so far.
-    TTL_num = -1
-    most_recent_gpio_time = -1
-    num_consec_TTLs = 0   # Use this to track double and triple pulses
-
-    codec = cv2.VideoWriter_fourcc(*FOURCC)  # What codec to use. Usually h264
-    resolution = (WIDTH, HEIGHT)
-    
-    helper_thread = None  # This is used to close files without blocking main thread
-
-    lock = None
-
-    frames_to_mark_GPIO = 0    # Use this to add blue dot to frames when GPIO is detected
-    pending_start_timer = 0    # This is used to show dark red dot temporarily while we are waiting to check if double pulse is actually double (i.e. no third pulse)
+
+    # Every attribute is listed here, so that instances have no __dict__. This makes attribute
+    # access in the per-frame path slightly faster, and catches misspelled attribute names.
+    __slots__ = ('cam', 'id_num', 'order', 'status', 'frame', 'frame_pool', 'frame_pool_idx', 'next_frame_due',
+                 'filename', 'filename_timestamp', 'filename_timestamp_TTL',
+                 'Writer', 'fid', 'fid_TTL', 'writer_ok', 'fid_ok', 'ts_buf', 'standby_writer', 'standby_filename',
+                 'encoder_thread', 'encode_queue', 'encode_free', 'dropped_frames',
+                 'start_time', 'state', 'GPIO_pin',
+                 'frame_num', 'TTL_num', 'TTL_buffer_nums', 'TTL_buffer_times', 'TTL_buffer_count',
+                 'most_recent_gpio_time', 'num_consec_TTLs',
+                 'codec', 'resolution', 'lock',
+                 'grab_thread', 'grab_running', 'frame_lock', 'latest_frame', 'frame_ready',
+                 'frames_to_mark_GPIO', 'pending_start_timer', 'start_thread', 'burst_event')
+
+    @property
+    def IsRecording(self):
+        return self.state == STATE_RECORDING
 
     def __init__(self, cam, id_num, order, GPIO_pin=-1):
-        self.cam = cam
-        self.id_num = id_num
-        self.order = order
-        self.GPIO_pin = GPIO_pin
-        self.lock = threading.RLock()  # Reentrant lock, so same thread can acquire more than once.
+        self.cam = cam         # this is the opencv camera object
+        self.id_num = id_num   # ID number assigned by operating system. May be unpredictable.
+        self.order = order     # User-friendly camera ID. Will usually be USB port position, and also position on screen
+        self.status = -1       # True if camera is operational and connected
+        self.frame = None      # Most recently obtained video frame. If camera lost connection, this will be a black frame with some text
+        self.frame_pool = None  # Preallocated buffers that camera frames are read into, so that no new array is allocated per frame
+        self.frame_pool_idx = 0  # Which buffer in frame_pool will receive the next frame
+        self.next_frame_due = 0  # When the next frame should be kept (ns, from time.monotonic_ns())
+        self.filename = "Video.avi"
+        self.filename_timestamp = "Timestamp.txt"
+        self.filename_timestamp_TTL = "Timestamp_TTL.txt"
+
+        # Various file writer objects
+        self.Writer = None    # Writer for video file
+        self.fid = None       # Writer for timestamp file
+        self.fid_TTL = None   # Writer for TTL timestamp file
+
+        # Creating a video writer can take tens of ms, so the next one is created in advance, writing to a
+        # temporary file. start_record() then just renames the file, instead of delaying the first frame.
+        self.standby_writer = None
+        self.standby_filename = None   # Temporary file name of standby_writer, renamed when recording starts
+
+        self.writer_ok = False  # Set False after a video write error, so we stop trying until next recording
+        self.fid_ok = False     # Set False after a timestamp write error, so we stop trying until next recording
+        self.ts_buf = bytearray()  # Frame timestamp lines not yet handed to fid. Written out in batches of TS_BUF_FLUSH_SIZE bytes.
+
+        # Video compression and file writing happen on a separate encoder thread, so that they can't stall capture
+        self.encoder_thread = None
+        self.encode_queue = None   # (frame, frame_num, time_ns) tuples waiting to be written, followed by None to stop
+        self.encode_free = None    # Preallocated frame buffers not currently in encode_queue (list, used as a stack)
+        self.dropped_frames = 0    # Frames not recorded because encoder had fallen too far behind
+
+        self.start_time = -1  # Timestamp when recording started, in integer nanoseconds from time.monotonic_ns()
+        self.state = STATE_IDLE   # One of STATE_IDLE, STATE_STARTING, STATE_RECORDING, STATE_STOPPING
+        self.GPIO_pin = GPIO_pin  # Which GPIO pin corresponds to this camera? First low-high transition will start recording.
+
+        self.frame_num = -1   # Number of frames recorded so far.
+        self.TTL_num = -1
+        # TTL timestamps are accumulated here, and written to disk in bulk by flush_TTL_buffer()
+        self.TTL_buffer_nums = np.empty(1024, dtype=np.int64)   # TTL event numbers not yet written to file
+        self.TTL_buffer_times = np.empty(1024, dtype=np.int64)  # TTL timestamps (ns relative to session start) not yet written to file
+        self.TTL_buffer_count = 0     # Number of valid entries in the above two arrays
+        self.most_recent_gpio_time = -1
+        self.num_consec_TTLs = 0   # Use this to track double and triple pulses
+
+        self.codec = cv2.VideoWriter_fourcc(*FOURCC)  # What codec to use. Usually h264
+        self.resolution = (WIDTH, HEIGHT)
+
+        # Frames are captured on a separate grabber thread, so that a slow display loop (or another
+        # slow camera) can't delay capture. read() then just hands out a copy of the latest frame.
+        self.grab_thread = None
+        self.grab_running = False
+        self.frame_lock = threading.Lock()   # Held while publishing or copying latest_frame
+        self.latest_frame = None             # Most recent frame from grabber thread
+        self.frame_ready = threading.Event()  # Set once first frame arrives, or grabber thread has exited
+
+        self.frames_to_mark_GPIO = 0    # Use this to add blue dot to frames when GPIO is detected
+        self.pending_start_timer = 0    # This is used to show dark red dot temporarily while we are waiting to check if double pulse is actually double (i.e. no third pulse)
+
+        # Decides whether a burst of TTLs should start recording. Thread is created on first TTL, and then reused.
+        self.start_thread = None
+        self.burst_event = threading.Event()   # Set by each TTL that arrives while not recording
+
+        self.lock = threading.Lock()  # Not reentrant. No code path acquires it while already holding it.
+
         if cam is None:
-            # Use blank frame for this object if no camera object is specified
+            # Use blank frame for this object if no camera object is specified. Status 0 tells the main
+            # loop that this frame never changes, so it doesn't need redrawing every frame.
             self.frame = make_blank_frame(f"{order} - No camera found")
+            self.status = 0
+        else:
+            # Frames are read into these buffers in rotation. Each frame therefore stays intact
+            # for two more reads after the one that produced it, giving any consumer time to use it.
+            self.frame_pool = [np.empty((HEIGHT, WIDTH, 3), dtype="uint8") for _ in range(3)]
 
-        if GPIO_pin >= 0 and platform.system() == "Linux":
-            # Start monitoring GPIO pin
-            GPIO.add_event_detect(GPIO_pin, GPIO.RISING, callback=self.GPIO_callback)
+            self.prepare_standby_writer()
 
-    def GPIO_callback(self, param):
+            self.grab_running = True
+            self.grab_thread = threading.Thread(target=self.grab_loop, daemon=True)
+            self.grab_thread.start()
 
-        self.handle_GPIO()
+        if GPIO_pin >= 0 and _IS_LINUX:
+            # Start monitoring GPIO pin. handle_GPIO is registered directly, without a
+            # wrapper, to avoid an extra Python call on every edge.
+            GPIO.add_event_detect(GPIO_pin, GPIO.RISING, callback=self.handle_GPIO)
 
-    def delayed_start(self):
+    def delayed_start_loop(self):
 
-        # This will wait a second to make sure no additional GPIOs occurred, then
-        # will start recording video
+        # Runs on a persistent thread. Each time a burst of TTLs arrives while not recording, waits
+        # to make sure no additional GPIOs occurred, then starts recording video if the burst was
+        # the right length.
 
-        # This timer is used to temporarily show dark red dot while start is pending
-        self.pending_start_timer = int(FRAME_RATE_PER_SECOND * 1.5)
+        # This thread is created from the (possibly real-time) GPIO callback thread, and itself creates
+        # encoder threads and video writers, none of which should run at real-time priority.
+        set_normal_scheduling()
 
-        time.sleep(MAX_INTERVAL_IN_TTL_BURST)
+        while True:
+            self.burst_event.wait()
 
-        if self.num_consec_TTLs != NUM_TTL_PULSES_TO_START_SESSION:
-            return
+            # Keep waiting until no TTL has arrived for MAX_INTERVAL_IN_TTL_BURST, i.e. burst is over.
+            # Each new TTL wakes us immediately, rather than sleeping out the full interval.
+            while True:
+                self.burst_event.clear()
+                if self.num_consec_TTLs == NUM_TTL_PULSES_TO_START_SESSION:
+                    # This timer is used to temporarily show dark red dot while start is pending
+                    self.pending_start_timer = int(FRAME_RATE_PER_SECOND * 1.5)
+                else:
+                    # Too few or too many pulses so far. Clear dot right away if start was pending.
+                    self.pending_start_timer = 0
+                if not self.burst_event.wait(MAX_INTERVAL_IN_TTL_BURST):
+                    break
+
+            if self.num_consec_TTLs != NUM_TTL_PULSES_TO_START_SESSION:
+                continue
+
+            if not self.start_record():
+                # Start recording failed, so don't record TTLs
+                print(f"Unable to start recording camera {self.order} in response to GPIO input")
+                continue
 
-        if not self.start_record():
-            # Start recording failed, so don't record TTLs
-            print(f"Unable to start recording camera {self.order} in response to GPIO input")
-            return
+            if not self.IsRecording:
+                # Not recording video, so don't save TTL timestamps
+                print("Hmmm, something seems wrong, GPIO recording didn't start after all. Please contact developer.")
 
-        if not self.IsRecording:
-            # Not recording video, so don't save TTL timestamps
-            print("Hmmm, something seems wrong, GPIO recording didn't start after all. Please contact developer.")
+    def handle_GPIO(self, channel=None):
 
-    def handle_GPIO(self):
+        # Detected rising edge of GPIO. This is registered directly as the GPIO callback, in which
+        # case channel is the pin number (unused). It is called with no argument when simulating TTLs.
 
-        # Detected rising edge of GPIO
+        # Record timestamp now, in case there are delays acquiring lock.
+        # time.monotonic_ns() returns integer nanoseconds, and unlike time.time() will
+        # not jump if the wall clock is adjusted (e.g. by NTP) in the middle of a session.
+        gpio_time = _monotonic_ns()
 
-        # Record timestamp now, in case there are delays acquiring lock
-        # time.time() returns number of seconds since 1970.
-        gpio_time = time.time()
+        if channel is not None and REALTIME_PRIORITY > 0 and not getattr(_gpio_thread_state, 'realtime', False):
+            # First edge seen on GPIO library's callback thread. Can't set this up in advance,
+            # since the library creates that thread itself.
+            _gpio_thread_state.realtime = True
+            set_thread_realtime(REALTIME_PRIORITY)
 
-        # Calculate interval from previous pulse. This is used to detect double-pulses that indicate
+        # Calculate interval (in ns) from previous pulse. This is used to detect double-pulses that indicate
         # session start/stop
         interval = gpio_time - self.most_recent_gpio_time
 
-        if interval <= 0.001:
+        if interval <= GPIO_DEBOUNCE_NS:
             # Ignore GPIOs less than 1ms apart. These are usually mechanical switch bounces, e.g. if
             # triggering manually by jumpering the GPIO pins.
             return
 
-        if interval > MAX_INTERVAL_IN_TTL_BURST:
+        if interval > MAX_INTERVAL_IN_TTL_BURST_NS:
             # Long interval resets count of consecutive TTLs
             self.num_consec_TTLs = 1
         else:
@@ -238,45 +541,48 @@ class CamObj:
 
         # Because this function is called from the GPIO callback thread, we need to
         # acquire lock to make sure main thread isn't also accessing the same variables.
-        # For example, if the main thread is in the midst of starting a recording, we need to
-        # wait for that to finish, or else we might start the recording twice (with very
-        # unpredictable results).
+        # For example, if the main thread is in the midst of stopping a recording, we need to
+        # wait for that to finish, or else we might write to a file that is being closed.
+        # The lock is held only while checking recording status and writing the TTL timestamp.
         with self.lock:
-
-            if not self.IsRecording:
-
-                if self.num_consec_TTLs == NUM_TTL_PULSES_TO_START_SESSION:
-
-                    t = threading.Thread(target=self.delayed_start)
-
-                    t.start()
-                    
-                    return
-
-                # At this point, we originally were not recording, and we either attempted to start a session
-                # or not, and we may or may not have succeeded.
-
-                # Either way, we now return. The reason is that if we are not recording,
-                # then there is no need to record timestamp. But if we did just start recording,
-                # the very first TTL timestamp is also superfluous, and will have a negative value,
-                # so we don't record that either.
-                return
-
-            # Calculate TTL timestamp relative to session start
-            gpio_time_relative = gpio_time - self.start_time
-
-            self.TTL_num += 1
-            if self.fid_TTL is not None:
-                try:
-                    self.fid_TTL.write(f"{self.TTL_num}\t{gpio_time_relative}\n")
-                except:
-                    print(f"Unable to write TTL file for camera {self.order}")
-            else:
-                print(f"Unable to write TTL timestamp for camera {self.order}")
+            is_recording = self.state == STATE_RECORDING
+
+            if is_recording:
+                # Calculate TTL timestamp relative to session start, in integer nanoseconds
+                gpio_time_relative = gpio_time - self.start_time
+
+                self.TTL_num += 1
+
+                # Store timestamp in memory rather than writing to disk, so that the GPIO
+                # callback returns quickly. The encoder thread writes the buffer out every FLUSH_INTERVAL_SEC,
+                # and when recording stops.
+                n = self.TTL_buffer_count
+                self.TTL_buffer_nums[n] = self.TTL_num
+                self.TTL_buffer_times[n] = gpio_time_relative
+                self.TTL_buffer_count = n + 1
+                if self.TTL_buffer_count >= len(self.TTL_buffer_nums):
+                    # Over a thousand TTLs since the last flush. Make room rather than writing to disk here,
+                    # so that this callback never has to wait for the disk.
+                    self.TTL_buffer_nums = np.concatenate((self.TTL_buffer_nums, np.empty_like(self.TTL_buffer_nums)))
+                    self.TTL_buffer_times = np.concatenate((self.TTL_buffer_times, np.empty_like(self.TTL_buffer_times)))
+
+        if not is_recording:
+
+            # Wake the delayed-start thread, which checks whether this burst should start a session.
+            # It acquires the lock itself (via start_record) once it has confirmed that no more pulses arrived.
+            if self.start_thread is None:
+                self.start_thread = threading.Thread(target=self.delayed_start_loop, daemon=True)
+                self.start_thread.start()
+            self.burst_event.set()
+
+            # If we are not recording, then there is no need to record timestamp. And if this pulse
+            # is part of a start burst, the TTL timestamp is superfluous, and would have a
+            # negative value, so we don't record that either.
+            return
 
         # By now lock has been released, and we are guaranteed to be recording.
 
-        if gpio_time_relative > 5.0 and self.num_consec_TTLs >= NUM_TTL_PULSES_TO_STOP_SESSION:
+        if gpio_time_relative > MIN_SESSION_BEFORE_STOP_NS and self.num_consec_TTLs >= NUM_TTL_PULSES_TO_STOP_SESSION:
             # Double pulses are pulses with about 1.0 seconds between rise times. They indicate
             # start and stop of session.
             self.stop_record()
@@ -286,183 +592,546 @@ class CamObj:
 
     def start_record(self):
 
-        if self.cam is None or not self.cam.isOpened():
+        # Status is kept up to date by the grabber thread, so no need to query the driver with isOpened()
+        if self.cam is None or not self.status:
             print(f"Camera {self.order} is not available for recording.")
             return False
 
         # Because this function might be called from the GPIO callback thread, we need to
-        # acquire lock to make sure it isn't also being called from the main thread.
+        # acquire lock to make sure it isn't also being called from the main thread. The lock
+        # is only held while changing state, not while creating files. The STARTING state
+        # prevents anyone else from starting or stopping a recording in the meantime.
         with self.lock:
-            if not self.IsRecording:
-                self.frame_num = 0
-                self.TTL_num = 0
+            if self.state != STATE_IDLE:
+                return False
+            self.state = STATE_STARTING
 
-                prefix = DATA_FOLDER + self.get_filename_prefix()
-                self.filename = prefix + "_Video.avi"
-                self.filename_timestamp = prefix + "_Frames.txt"
-                self.filename_timestamp_TTL = prefix + "_TTLs.txt"
+        if not self.open_files():
+            with self.lock:
+                self.state = STATE_IDLE
+            return False
 
+        with self.lock:
+            # Set start time before changing state, since read() uses it as soon as state is RECORDING
+            self.start_time = time.monotonic_ns()
+            self.state = STATE_RECORDING
+
+        printt(f"Started recording camera {self.order} to file '{self.filename}'")
+        return True
+
+    def open_files(self):
+
+        # Creates video and timestamp files, and starts encoder thread. Returns True if successful.
+        # Only called from start_record(), while in STARTING state.
+
+        self.frame_num = 0
+        self.TTL_num = 0
+        self.TTL_buffer_count = 0
+        self.ts_buf.clear()
+
+        prefix = DATA_FOLDER + self.get_filename_prefix()
+        self.filename_timestamp = prefix + "_Frames.txt"
+        self.filename_timestamp_TTL = prefix + "_TTLs.txt"
+
+        self.Writer = None
+        if self.standby_writer is not None:
+            # Writer was created in advance, so just rename its file
+            writer, standby_filename = self.standby_writer, self.standby_filename
+            self.standby_writer = None
+            self.standby_filename = None
+            self.filename = prefix + "_Video" + os.path.splitext(standby_filename)[1]
+            try:
+                os.replace(standby_filename, self.filename)
+                self.Writer = writer
+            except OSError:
+                # Recording into the temporary file instead would risk losing it, since it is overwritten
+                # by the next standby writer if the program crashes. So discard it, and start afresh below.
+                writer.release()
                 try:
-                    # Create video file
-                    self.Writer = cv2.VideoWriter(self.filename, self.codec, FRAME_RATE_PER_SECOND, self.resolution)
-                except:
-                    print(f"Warning: unable to create video file: '{self.filename}'")
-                    return False
+                    os.remove(standby_filename)
+                except OSError:
+                    pass
 
-                if not self.Writer.isOpened():
-                    # If codec is missing, we might get here. Usually OpenCV will have reported the error already.
-                    print(f"Warning: unable to create video file: '{self.filename}'")
-                    return False
+        if self.Writer is None:
+            # Create video file
+            self.Writer, self.filename = self.open_video_writer(prefix)
+            if self.Writer is None:
+                return False
 
-                try:
-                    # Create text file for frame timestamps
-                    self.fid = open(self.filename_timestamp, 'w')
-                    self.fid.write('Frame_number\tTime_in_seconds\n')
-                except:
-                    print("Warning: unable to create text file for frame timestamps")
-                    
-                    # Close the previously-created writer objects
-                    self.Writer.release()
-                    return False
+        try:
+            # Create text file for frame timestamps. Path is converted to the filesystem
+            # encoding once here, so that open() does not have to. Opened in binary mode
+            # and unbuffered, since timestamps are already collected into large batches of
+            # ASCII bytes in ts_buf. Each batch then goes straight to a write() system call.
+            self.fid = open(os.fsencode(self.filename_timestamp), 'wb', buffering=0)
+            self.ts_buf += b'Frame_number\tTime_in_seconds\n'
+        except:
+            print("Warning: unable to create text file for frame timestamps")
+            
+            # Close the previously-created writer objects
+            self.Writer.release()
+            self.Writer = None
+            return False
 
-                try:
-                    # Create text file for TTL timestamps
-                    self.fid_TTL = open(self.filename_timestamp_TTL, 'w')
-                    self.fid_TTL.write('TTL_event_number\tTime_in_seconds\n')
-                except:
-                    print("Warning: unable to create text file for TTL timestamps")
-                    
-                    # Close the previously-created writer objects
-                    self.fid.close()
-                    self.Writer.release()
-                    return False
-
-                self.IsRecording = True
-                self.start_time = time.time()
-
-                printt(f"Started recording camera {self.order} to file '{self.filename}'")
-                return True
+        try:
+            # Create text file for TTL timestamps. Unbuffered for the same reason as above:
+            # flush_TTL_buffer() formats each batch into one bytes object and writes it at once.
+            self.fid_TTL = open(os.fsencode(self.filename_timestamp_TTL), 'wb', buffering=0)
+            write_all(self.fid_TTL, b'TTL_event_number\tTime_in_seconds\n')
+        except:
+            print("Warning: unable to create text file for TTL timestamps")
+            
+            # Close the previously-created writer objects
+            self.fid.close()
+            self.fid = None
+            self.Writer.release()
+            self.Writer = None
+            return False
 
-    def stop_record(self):
+        self.writer_ok = True
+        self.fid_ok = True
+
+        # Set up encoder thread. Frames are copied into a fixed pool of buffers, which also limits
+        # how far behind the encoder can get.
+        self.dropped_frames = 0
+        self.encode_queue = queue.SimpleQueue()
+        # Free buffers are kept in a plain list and used last-in, first-out. While the encoder keeps up,
+        # the same one or two (cache-warm) buffers are reused, and the rest are never touched. list.append()
+        # and list.pop() are each atomic, so no lock is needed between grabber and encoder threads.
+        self.encode_free = [np.empty((HEIGHT, WIDTH, 3), dtype="uint8") for _ in range(ENCODE_QUEUE_SIZE)]
+        self.encoder_thread = threading.Thread(target=self.encode_loop,
+                                               args=(self.encode_queue, self.encode_free))
+        self.encoder_thread.start()
+
+        return True
+
+    def open_video_writer(self, prefix):
 
-        # Close and release all file writers
-        # Do it on a separate thread to avoid dropping frames
-        self.helper_thread = threading.Thread(target=self.stop_record_thread)
-        self.helper_thread.start()
+        # Creates video file. Returns writer object and file name, or None and file name if failed.
 
-    def stop_record_thread(self):
+        if CAPTURE_CPU < 0 or not _IS_LINUX:
+            return self.create_video_writer(prefix)
 
-        # Close and release all file writers
+        # GStreamer's streaming and x264 threads (and an ffmpeg process) inherit the CPU affinity of the thread
+        # that creates them. Writers created on the encoder thread are already kept off the capture core, but the
+        # first one is created on the main thread, so move this thread off the capture core while doing so.
+        old_cpus = os.sched_getaffinity(0)
+        set_thread_affinity(set(range(os.cpu_count())) - {CAPTURE_CPU})
+        try:
+            return self.create_video_writer(prefix)
+        finally:
+            set_thread_affinity(old_cpus)
+
+    def create_video_writer(self, prefix):
+
+        # Does the work for open_video_writer()
+
+        if USE_FFMPEG:
+            # Matroska file is still readable if program is interrupted before file is closed
+            filename = prefix + "_Video.mkv"
+            try:
+                writer = FFmpegWriter(filename, FRAME_RATE_PER_SECOND, self.resolution)
+                if writer.isOpened():
+                    return writer, filename
+            except OSError:
+                pass
+            print("Unable to start ffmpeg, will use OpenCV video writer instead")
+
+        if USE_GSTREAMER:
+            # GStreamer pipeline lets us tune x264 for speed. Matroska container has lower muxing overhead than AVI.
+            filename = prefix + "_Video.mkv"
+            pipeline = ("appsrc ! videoconvert ! "
+                        f"x264enc speed-preset=ultrafast tune=zerolatency bitrate=2000 threads=2 key-int-max={int(FRAME_RATE_PER_SECOND)} ! "
+                        f"h264parse ! matroskamux ! filesink location=\"{filename}\"")
+            try:
+                writer = cv2.VideoWriter(pipeline, cv2.CAP_GSTREAMER, 0, FRAME_RATE_PER_SECOND, self.resolution,
+                                         RECORD_COLOR)
+                if writer.isOpened():
+                    return writer, filename
+            except:
+                pass
+            global _gstreamer_warned
+            if not _gstreamer_warned:
+                # Writers are also created in advance, so this would otherwise be repeated for every camera and recording
+                _gstreamer_warned = True
+                print("GStreamer video pipeline not available, will use FOURCC codec instead")
+
+        filename = prefix + "_Video.avi"
+        try:
+            writer = cv2.VideoWriter(filename, self.codec, FRAME_RATE_PER_SECOND, self.resolution, RECORD_COLOR)
+        except:
+            print(f"Warning: unable to create video file: '{filename}'")
+            return None, filename
+
+        if not writer.isOpened():
+            # If codec is missing, we might get here. Usually OpenCV will have reported the error already.
+            print(f"Warning: unable to create video file: '{filename}'")
+            return None, filename
+
+        return writer, filename
+
+    def prepare_standby_writer(self):
+
+        # Creates video writer for next recording, writing to a temporary file until recording starts.
+        # Only called when not recording, and nobody else can start one (in __init__, or while STOPPING).
+        if _IS_WINDOWS:
+            # Windows doesn't allow renaming a file that is open, so the file would have to keep its
+            # temporary name until recording ends. Just create the dated file when recording starts.
+            return
+        writer, filename = self.open_video_writer(DATA_FOLDER + f"Cam{self.order}_standby")
+        if writer is not None:
+            self.standby_writer = writer
+            self.standby_filename = filename
+
+    def release_standby_writer(self):
+
+        # Discards writer created in advance, along with its (empty) temporary file
+        if self.standby_writer is None:
+            return
+        try:
+            self.standby_writer.release()
+            os.remove(self.standby_filename)
+        except:
+            pass
+        self.standby_writer = None
+        self.standby_filename = None
+
+    def flush_TTL_buffer(self):
+
+        # Writes all buffered TTL timestamps to file in a single call. Only called on the encoder thread,
+        # which owns fid_TTL. Lock is held just long enough to take the batch out of the buffer, so that
+        # the GPIO callback (and its timestamps) are never held up by a slow disk.
         with self.lock:
+            n = self.TTL_buffer_count
+            if n == 0:
+                return
+            nums = self.TTL_buffer_nums[:n].tolist()
+            times = self.TTL_buffer_times[:n].copy()
+            self.TTL_buffer_count = 0
 
-            # Acquire lock to avoid starting a new recording
-            # in the middle of stopping the old one.
+        if self.fid_TTL is None:
+            print(f"Unable to write TTL timestamps for camera {self.order}")
+            return
 
-            if self.IsRecording:
-                printt(f"Stopping recording camera {self.order} after " + self.get_elapsed_time_string())
+        # Split nanoseconds into whole seconds and remainder, then format all rows into one
+        # bytes object, so the whole batch goes to disk in a single write() system call.
+        sec, ns = np.divmod(times, 1_000_000_000)
+        rows = zip(nums, sec.tolist(), ns.tolist())
+        try:
+            write_all(self.fid_TTL, b"".join([b"%d\t%d.%09d\n" % row for row in rows]))
+        except (OSError, ValueError) as e:
+            print(f"Unable to write TTL file for camera {self.order}: {e}")
+
+    def write_ts_buf(self):
+
+        # Writes all buffered frame timestamps to file, and empties buffer.
+        write_all(self.fid, self.ts_buf)
+        self.ts_buf.clear()
+
+    def encode_loop(self, encode_queue, encode_free):
+
+        # Runs on the encoder thread for the duration of one recording. Writes frames and their
+        # timestamps to file, until it receives None (from stop_record) or a write fails. Then
+        # closes all files. Doing this here guarantees that the last frame is written before the
+        # files are closed, and means that stopping doesn't need a thread of its own.
+
+        # May have inherited real-time priority from the thread that started recording
+        set_normal_scheduling()
 
-                self.IsRecording = False
+        if CAPTURE_CPU >= 0:
+            # Capture thread has been given its own core, so keep compression off it
+            set_thread_affinity(set(range(os.cpu_count())) - {CAPTURE_CPU})
 
-            if self.Writer is not None:
+        if REALTIME_PRIORITY > 0 and _IS_LINUX:
+            # Compression is the one thing that can wait, so make sure it yields to everything else.
+            # (Lowering priority is always allowed, and on Linux only affects this thread.)
+            os.nice(5)
+
+        try:
+            next_flush = time.monotonic() + FLUSH_INTERVAL_SEC
+
+            # Grayscale frame that is actually written, if not recording in color. Capture thread still
+            # hands over full BGR frames, so that it does no extra work.
+            gray = None if RECORD_COLOR else np.empty((HEIGHT, WIDTH), dtype="uint8")
+
+            while True:
                 try:
-                    # Close Video file
-                    self.Writer.release()
-                except:
-                    pass
-                self.Writer = None
-            if self.fid is not None:
+                    # Timeout ensures TTLs still get written if camera stops delivering frames
+                    item = encode_queue.get(timeout=FLUSH_INTERVAL_SEC)
+                except queue.Empty:
+                    item = ()
+
+                flush_due = time.monotonic() >= next_flush
+                if flush_due:
+                    next_flush = time.monotonic() + FLUSH_INTERVAL_SEC
+                    self.flush_TTL_buffer()
+
+                if item is None:
+                    break
+                if not item:
+                    continue
+                frame, frame_num, time_ns = item
+
                 try:
-                    # Close text timestamp file
-                    self.fid.close()
-                except:
-                    pass
-                self.fid = None
-            if self.fid_TTL is not None:
+                    # Timestamp was taken when frame was captured. Line is appended to a memory buffer,
+                    # which is written to file about once per second.
+                    sec, ns = divmod(time_ns, 1_000_000_000)
+                    self.ts_buf += b"%d\t%d.%09d\n" % (frame_num, sec, ns)
+                    if flush_due or len(self.ts_buf) > TS_BUF_FLUSH_SIZE:
+                        self.write_ts_buf()
+                except OSError as e:
+                    print(f"Unable to write text file for camera {self.order}: {e}. Will stop recording")
+                    self.fid_ok = False
+                    break
+
                 try:
-                    # Close text timestamp file
-                    self.fid_TTL.close()
-                except:
-                    pass
-                self.fid_TTL = None
-                
-            self.helper_thread = None
+                    # Write frame to video file
+                    if gray is None:
+                        self.Writer.write(frame)
+                    elif frame.shape[:2] == gray.shape:
+                        self.Writer.write(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray))
+                    else:
+                        self.Writer.write(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+                except (cv2.error, OSError) as e:
+                    # OSError comes from FFmpegWriter, e.g. if ffmpeg has exited
+                    print(f"Unable to write video file for camera {self.order}: {e}. Will stop recording")
+                    self.writer_ok = False
+                    break
+
+                # Buffer can now be reused for another frame
+                encode_free.append(frame)
+
+        finally:
+            # Always close files and leave RECORDING state, even if something unexpected went wrong above.
+            # Otherwise the recording could never be stopped, and its files would never be closed.
+            self.close_files()
+
+    def close_files(self):
+
+        # Called on encoder thread when it is done. Lock is only held while changing state, so
+        # that the GPIO callback is not blocked while files are closed.
+        with self.lock:
+            # Already STOPPING if stop_record() was called. Otherwise a write failed, and
+            # we need to make sure no further frames or TTLs are added.
+            self.state = STATE_STOPPING
+
+        printt(f"Stopping recording camera {self.order} after " + self.get_elapsed_time_string())
+
+        # Queues are left in place, in case the grabber thread is in the middle of process_frame() and still
+        # queues one last frame. That frame is simply discarded along with the queue next session.
+        if self.dropped_frames > 0:
+            printt(f"Warning: camera {self.order} dropped {self.dropped_frames} frame(s) because video encoding fell behind. "
+                   f"Consider increasing ENCODE_BUFFER_FRAMES (currently {ENCODE_QUEUE_SIZE}), or lowering frame rate.")
+
+        # Nobody else touches the files in STOPPING state, so no lock is needed below.
+        if self.Writer is not None:
+            try:
+                # Close Video file
+                self.Writer.release()
+            except:
+                pass
+            self.Writer = None
+        if self.fid is not None:
+            try:
+                # Write any remaining timestamps, then close text timestamp file
+                self.write_ts_buf()
+                self.fid.close()
+            except:
+                pass
+            self.fid = None
+        if self.fid_TTL is not None:
+            try:
+                # Write any remaining TTL timestamps, make sure they reach the disk, then close file
+                self.flush_TTL_buffer()
+                os.fsync(self.fid_TTL.fileno())
+                self.fid_TTL.close()
+            except:
+                pass
+            self.fid_TTL = None
+
+        if self.grab_thread is not None and self.grab_running:
+            # Get ready for next recording. Done before leaving STOPPING state, so no recording can start meanwhile.
+            # Skipped if the camera was lost or is being closed, since there won't be a next recording.
+            self.prepare_standby_writer()
+
+        with self.lock:
+            self.state = STATE_IDLE
+
+    def stop_record(self):
+
+        # Asks encoder thread to write any frames already queued, then close all files. Returns
+        # immediately, to avoid dropping frames. Use close() to wait for files to be closed.
+        with self.lock:
+            if self.state != STATE_RECORDING:
+                # Either not recording, or another thread is already starting or stopping.
+                return
+            self.state = STATE_STOPPING
+            self.encode_queue.put(None)
 
     def read_one_frame(self):
+
+        # Returns next frame from camera, along with the time grab() returned it in integer nanoseconds,
+        # or None if camera has failed
         try:
-            # Read frame if camera is available and open
-            self.status, self.frame = self.cam.read()
-            return self.cam.isOpened() and self.status
-        except:
-            return False
+            while True:
+                # Dequeue the next frame from the driver. This is cheap, as it does not decode anything.
+                if not self.cam.grab():
+                    return None
+
+                # Recording used to be paced by the main loop. Now that every frame the camera delivers
+                # arrives here, skip (without decoding) any that come too early, in case the camera is
+                # running faster than FRAME_RATE_PER_SECOND. Half a period of leeway means that normal
+                # jitter never causes skips when the camera runs at the requested rate.
+                now = _monotonic_ns()
+                if now >= self.next_frame_due - (FRAME_PERIOD_NS >> 1):
+                    break
+
+            # Schedule next frame exactly one period after this one was due, so that the recorded rate
+            # matches FRAME_RATE_PER_SECOND over the long run. If we have fallen more than a period
+            # behind (e.g. camera paused, or camera slower than requested), start again from now rather
+            # than trying to catch up.
+            due = self.next_frame_due + FRAME_PERIOD_NS
+            self.next_frame_due = due if due > now - FRAME_PERIOD_NS else now + FRAME_PERIOD_NS
+
+            # Now decode it. Passing a preallocated buffer lets OpenCV write into it directly
+            # instead of allocating a new array on every frame.
+            idx = self.frame_pool_idx
+            self.frame_pool_idx = (idx + 1) % len(self.frame_pool)
+            ok, frame = self.cam.retrieve(self.frame_pool[idx])
+            if not ok:
+                return None
+            if frame is not self.frame_pool[idx]:
+                # Camera delivered a different size than requested, so OpenCV had to allocate.
+                # Keep the new array, so that it is reused next time around.
+                self.frame_pool[idx] = frame
+            return frame, now
+        except cv2.error:
+            return None
+
+    def grab_loop(self):
+
+        # Runs on the grabber thread for as long as the camera is connected, or until close().
+
+        if CAPTURE_CPU >= 0:
+            # Keep camera capture on its own core, and raise its priority so that it is not
+            # preempted by compression work on other cores.
+            set_thread_affinity({CAPTURE_CPU}, -5)
+
+        # Grabber thread spends nearly all its time blocked in grab(), so real-time priority
+        # just means it wakes up immediately when a frame arrives.
+        set_thread_realtime(REALTIME_PRIORITY)
 
-    # Reads a single frame from CamObj class and writes it to file
+        try:
+            while self.grab_running:
+                result = self.read_one_frame()
+                if result is None:
+                    break
+                frame, grab_time = result
+
+                self.process_frame(frame, grab_time)
+
+                # Publish frame for read(). The next read_one_frame() call writes into a different
+                # pool buffer, so this one stays intact while read() copies it.
+                with self.frame_lock:
+                    self.latest_frame = frame
+                    self.status = True
+                self.frame_ready.set()
+        finally:
+            # Tells read() that camera is no longer delivering frames. This runs even if an
+            # unexpected exception escapes the loop, so that read() doesn't wait forever.
+            self.status = 0
+            self.frame_ready.set()
+
+    def process_frame(self, frame, grab_time):
+
+        # Runs on the grabber thread for every captured frame. Adds status dots, and hands a copy to
+        # the encoder thread if recording. grab_time is when grab() returned, from read_one_frame().
+
+        if self.frames_to_mark_GPIO > 0:
+            # Add blue dot to indicate that GPIO was recently detected
+            self.frames_to_mark_GPIO -= 1
+            cv2.circle(frame,
+                       GPIO_DOT_POSITION,
+                       DOT_RADIUS,
+                       (255, 0, 0),     # Blue dot (color is in BGR order)
+                       -1)   # -1 thickness fills circle
+
+        if self.pending_start_timer > 0:
+            # Add dark red dot to indicate that a start might be pending
+            self.pending_start_timer -= 1
+            cv2.circle(frame,
+                       RECORD_DOT_POSITION,
+                       DOT_RADIUS,
+                       (0, 0, 96),     # Dark red dot (color is in BGR order)
+                       -1)   # -1 thickness fills circle
+
+        # Once either write has failed, skip the whole write path until the (asynchronous)
+        # stop has completed, instead of retrying and failing again on every frame.
+        # Frames grabbed before recording started are skipped, so that timestamps are never negative.
+        if self.writer_ok and self.fid_ok and self.state == STATE_RECORDING and grab_time >= self.start_time:
+            # Use the time grab() returned, rather than now, since retrieve() (which may have to decode
+            # MJPG) and drawing the dots take a variable amount of time.
+            # Integer nanosecond arithmetic; only formatted to seconds when written.
+            time_ns = grab_time - self.start_time
+
+            try:
+                buf = self.encode_free.pop()
+            except IndexError:
+                # Encoder has fallen behind, and all buffers are waiting to be written. Drop
+                # this frame rather than stall capture. Timestamp file only lists recorded frames.
+                self.dropped_frames += 1
+            else:
+                # Hand the encoder its own copy, since this pool buffer will be reused for capture
+                if buf.shape == frame.shape:
+                    np.copyto(buf, frame)
+                else:
+                    buf = frame.copy()
+                frame_num = self.frame_num
+                self.encode_queue.put((buf, frame_num, time_ns))
+                self.frame_num = frame_num + 1
+
+    # Returns the most recent frame from the grabber thread. The copy in self.frame belongs to the
+    # caller, who can draw on it without affecting the recording.
     def read(self):
 
-        if self.cam is not None and self.cam.isOpened():
+        if self.grab_thread is None:
+            # Camera is not available.
+            return 0, None
 
-            if not self.read_one_frame():
+        # Only blocks until the first frame has arrived
+        self.frame_ready.wait()
 
-                # Read failed. Remove this camera so we won't attempt to read it later.
-                # Should we set a flag to try to periodically reconnect?
+        if not self.status:
 
-                if self.IsRecording:
-                    self.stop_record()  # Close file writers
+            # Grabber thread has stopped, so read failed. Remove this camera so we won't attempt to read it later.
+            # Should we set a flag to try to periodically reconnect?
+            self.grab_thread.join()
+            self.grab_thread = None
 
-                self.frame = make_blank_frame(f"{self.order} Camera lost connection")
-                # Warn user that something is wrong.
-                printt(f"Unable to read video from camera with ID {self.order}. Will remove camera from available list, and stop any ongoing recordings.")
+            if self.IsRecording:
+                self.stop_record()  # Close file writers
+
+            # Camera will not be read again, so draw the blank frame into the existing display buffer,
+            # and release the capture buffers. (The encoder thread, if any, has its own buffers.)
+            self.frame = make_blank_frame(f"{self.order} Camera lost connection", out=self.frame)
+            self.frame_pool = None
+            self.latest_frame = None
+            # Warn user that something is wrong.
+            printt(f"Unable to read video from camera with ID {self.order}. Will remove camera from available list, and stop any ongoing recordings.")
+
+            # Remove camera resources
+            self.cam.release()
+            self.cam = None
+            return 0, self.frame
 
-                # Remove camera resources
-                self.cam.release()
-                self.cam = None
-                self.status = 0
-                return 0, self.frame
-
-            if self.frames_to_mark_GPIO > 0:
-                # Add blue dot to indicate that GPIO was recently detected
-                self.frames_to_mark_GPIO -= 1
-                cv2.circle(self.frame,
-                           (int(20 * FONT_SCALE), int(70 * FONT_SCALE)),  # x-y position
-                           int(8 * FONT_SCALE),  # Radius
-                           (255, 0, 0),     # Blue dot (color is in BGR order)
-                           -1)   # -1 thickness fills circle
-
-            if self.pending_start_timer > 0:
-                # Add dark red dot to indicate that a start might be pending
-                self.pending_start_timer -= 1
-                cv2.circle(self.frame,
-                           (int(20 * FONT_SCALE), int(50 * FONT_SCALE)),  # x-y position
-                           int(8 * FONT_SCALE),  # Radius
-                           (0, 0, 96),     # Dark red dot (color is in BGR order)
-                           -1)   # -1 thickness fills circle
-
-            if self.Writer is not None and self.frame is not None and self.IsRecording:
-                if self.fid is not None and self.start_time > 0:
-                    # Write timestamp to text file. Do this before writing AVI so that
-                    # timestamp will not be delayed by latency required to compress video. This
-                    # ensures most accurate possible timestamp.
-                    try:
-                        time_elapsed = time.time() - self.start_time
-                        self.fid.write(f"{self.frame_num}\t{time_elapsed}\n")
-                    except:
-                        print(f"Unable to write text file for camera f{self.order}. Will stop recording")
-                        self.stop_record()
-                        return 0, None
-
-                self.frame_num += 1
-
-                if self.Writer is not None:
-                    try:
-                        # Write frame to AVI video file if possible
-                        self.Writer.write(self.frame)
-                    except:
-                        print(f"Unable to write video file for camera {self.order}. Will stop recording")
-                        self.stop_record()
-
-            return self.status, self.frame
-        else:
-            # Camera is not available.
-            return 0, None
+        with self.frame_lock:
+            latest = self.latest_frame
+            if self.frame is not None and self.frame.shape == latest.shape:
+                np.copyto(self.frame, latest)
+            else:
+                self.frame = latest.copy()
+
+        return self.status, self.frame
 
     def print_elapsed(self):
 
@@ -479,18 +1148,42 @@ class CamObj:
         return str1 + f", {self.frame_num} frames"
 
     def take_snapshot(self):
-        if self.cam is None or self.frame is None:
+        if self.cam is None or self.frame is None or not self.status:
+            return
+        fname = self.get_filename_prefix() + "_snapshot.jpg"
+
+        # JPEG compression and file write happen on a separate thread, so that the display loop is not held up.
+        # Frame is copied first, since the main loop will overwrite it.
+        threading.Thread(target=self.write_snapshot, args=(fname, self.frame.copy())).start()
+
+    def write_snapshot(self, fname, frame):
+        ok, buf = cv2.imencode(".jpg", frame)
+        if not ok:
+            printt(f"Unable to encode snapshot for camera {self.order}")
             return
-        if self.cam.isOpened():
-            fname = self.get_filename_prefix() + "_snapshot.jpg"
-            cv2.imwrite(fname, self.frame)
+        try:
+            # Encoded image is written in one call, so no need for Python's write buffer
+            with open(fname, 'wb', buffering=0) as f:
+                f.write(buf)
+        except OSError:
+            printt(f"Unable to write snapshot file '{fname}'")
 
     def close(self):
 
         # Only call this when exiting program. Will stop all recordings, and release camera resources
 
-        self.stop_record()  # This will run in a separate thread, and will close all files.
-        
+        # Tell grabber thread to stop first, so that the encoder thread doesn't create a new standby writer
+        # when it closes the files.
+        self.grab_running = False
+
+        self.stop_record()  # Encoder thread will write remaining frames, and close all files.
+
+        t = self.grab_thread
+        if t is not None:
+            # Let grabber thread finish its current frame before camera is released underneath it
+            t.join(timeout=2)
+            self.grab_thread = None
+
         if self.cam is not None:
             try:
                 # Release camera resources
@@ -502,14 +1195,14 @@ class CamObj:
         self.status = -1
         self.frame = None
         
-        # Now wait for helper thread to finish
-        with self.lock:
-            # Acquiring lock will block while helper thread is running.
-            # So by the time we acquire it, the helper thread will have
-            # already ended, and the following is probably superfluous.
-            if self.helper_thread is not None:
-                # Wait for helper thread to stop
-                self.helper_thread.join()
+        # Now wait for encoder thread to finish. Must not hold the lock while joining, since
+        # the encoder thread itself needs the lock to close files.
+        t = self.encoder_thread
+        if t is not None:
+            t.join()
+
+        # Encoder thread has finished, so it won't create another standby writer
+        self.release_standby_writer()
         
 if __name__ == '__main__':
     print("CamObj.py is a helper file, intended to be imported from WEBCAM_RECORD.py, not run by itself")
@@ -1,7 +1,8 @@
 import time
 import numpy as np
 import math
-from CamObj import CamObj, WIDTH, HEIGHT, FRAME_RATE_PER_SECOND, make_blank_frame, FONT_SCALE, printt
+from CamObj import CamObj, WIDTH, HEIGHT, FRAME_RATE_PER_SECOND, make_blank_frame, FONT_SCALE, printt, CAPTURE_CPU, \
+    LABEL_POSITION, LABEL_THICKNESS, DOT_RADIUS, RECORD_DOT_POSITION, CAMERA_FOURCC
 from get_hardware_info import *
 import cv2
 from sys import gettrace
@@ -70,8 +71,17 @@ def setup_cam(id):
         tmp = cv2.VideoCapture(id)
 
     if tmp.isOpened():
+        if CAMERA_FOURCC:
+            # Must be set before resolution, as not every resolution is available in every format
+            tmp.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*CAMERA_FOURCC))
         tmp.set(cv2.CAP_PROP_FRAME_WIDTH, WIDTH)
         tmp.set(cv2.CAP_PROP_FRAME_HEIGHT, HEIGHT)
+        tmp.set(cv2.CAP_PROP_FPS, FRAME_RATE_PER_SECOND)
+        # Each camera's grabber thread collects frames as soon as they arrive, so the driver doesn't need
+        # to queue up many. Fewer buffers means a late grab() gets a fresh frame, not one that has been
+        # waiting in the queue, so timestamps stay close to the actual capture time. Two buffers rather
+        # than one lets the camera fill the next frame while the previous one is still being decoded.
+        tmp.set(cv2.CAP_PROP_BUFFERSIZE, 2)
         if not tmp.isOpened():
             print(f"Resolution {WIDTH}x{HEIGHT} not supported. Please change config.txt.")
     return tmp
@@ -240,13 +250,17 @@ FRAME_INTERVAL = 1.0 / FRAME_RATE_PER_SECOND
 # Report status every 30 seconds
 STATUS_REPORT_INTERVAL = FRAME_RATE_PER_SECOND * 30
 
+if CAPTURE_CPU >= 0:
+    # Each camera's grabber thread pins itself to this core when it starts
+    printt(f"Camera capture threads are pinned to CPU core {CAPTURE_CPU}")
+
 print()
 printt("Starting display")
 
 # infinite loop
-# Camera frame is read at the very beginning of loop. At the end of the loop, is a timer
-# that waits until 1/FRAME_RATE_PER_SECOND seconds after previous frame target, forcing all
-# cameras to sync up at this interval.
+# Latest camera frames are fetched at the very beginning of loop. (Cameras are captured and
+# recorded on their own threads, so this never waits for a camera.) At the end of the loop, is a
+# timer that waits until 1/FRAME_RATE_PER_SECOND seconds after previous frame target.
 while True:
 
     for idx, cam_obj in enumerate(cam_array):
@@ -256,14 +270,14 @@ while True:
         if cam_obj.status:
             # Add text to top left to show camera number
             cv2.putText(cam_obj.frame, str(FIRST_CAMERA_ID + idx),
-                        (int(10 * FONT_SCALE), int(30 * FONT_SCALE)),
+                        LABEL_POSITION,
                         cv2.FONT_HERSHEY_SIMPLEX, FONT_SCALE, (255, 255, 255),
-                        round(FONT_SCALE + 0.5))  # Line thickness
+                        LABEL_THICKNESS)
             if cam_obj.IsRecording:
                 # Add red circle if recording
                 cv2.circle(cam_obj.frame,
-                           (int(20 * FONT_SCALE), int(50 * FONT_SCALE)),  # x-y position
-                           int(8 * FONT_SCALE),  # Radius
+                           RECORD_DOT_POSITION,
+                           DOT_RADIUS,
                            (0, 0, 255),     # Red dot (color is in BGR order)
                            -1)   # -1 thickness fills circle
 
@@ -301,7 +315,9 @@ while True:
         # Now that the first few frames are done, we can start timer and should get stable FPS readings
         # Another 40ms sleep to ensure frame is present
         time.sleep(.04)
-        start = time.time()
+        # Monotonic clock is used for frame pacing, so that wall clock adjustments (e.g. by NTP) do not
+        # cause a burst of catch-up frames or a long stall.
+        start = time.monotonic()
 
         # This is actually target time for the frame AFTER the next, since the next one will be read immediately
         next_frame = start + FRAME_INTERVAL
@@ -351,8 +367,8 @@ while True:
         elif key == ord("w"):
             # Write JPG images for each camera
             for cam_obj in cam_array:
-                if cam_obj.cam.isOpened():
-                    cam_obj.take_snapshot()
+                # Does nothing for cameras that are not connected
+                cam_obj.take_snapshot()
         elif key >= ord("0") and key <= ord("9"):
             # Start/stop recording for specified camera
             cam_num = key - ord("0")
@@ -382,7 +398,7 @@ while True:
     if frame_count % STATUS_REPORT_INTERVAL == 0:
         # Print status periodically (frame # and frames per second)
         if VERBOSE:
-            elapsed = time.time() - start
+            elapsed = time.monotonic() - start
             fps = frame_count / elapsed
             print(f"Frame count: {frame_count}, frames per second = {fps}")
 
@@ -394,21 +410,22 @@ while True:
                         if x.IsRecording:
                             x.print_elapsed()
 
-    if time.time() > next_frame:
-        # We are already too late for next frame. Oops. Report warning if any recording is ongoing, as there might be missed frames
-        lag_ms = (time.time() - next_frame) * 1000
+    if time.monotonic() > next_frame:
+        # We are already too late for next frame. Oops. Report warning if any recording is ongoing. Recording itself
+        # happens on the camera threads, but a lagging CPU means they might be falling behind too.
+        lag_ms = (time.monotonic() - next_frame) * 1000
         if any_camera_recording(cam_array):
-            printt(f"Warning: CPU is lagging by {lag_ms:.2f} ms. Might experience up to {int(math.ceil(lag_ms/100))} dropped frame(s).")
+            printt(f"Warning: CPU is lagging by {lag_ms:.2f} ms. Display might skip up to {int(math.ceil(lag_ms/100))} frame(s).")
 
         # Next frame will actually be retrieved immediately. The following time is actually for the frame after that.
-        next_frame = time.time() + FRAME_INTERVAL
+        next_frame = time.monotonic() + FRAME_INTERVAL
     else:
         # We are done with loop, but not ready to request next frame. Wait a bit.
-        advance_ms = (next_frame - time.time()) * 1000
+        advance_ms = (next_frame - time.monotonic()) * 1000
         # print("CPU is ahead by " + f"{advance_ms:.2f}" + " ms")
         # Wait until next frame interval has elapsed
-        while time.time() < next_frame:
-            if next_frame - time.time() > 0.005:
+        while time.monotonic() < next_frame:
+            if next_frame - time.monotonic() > 0.005:
                 # Sleep in 5ms increments to reduce CPU usage. Otherwise this
                 # loop will hog close to 100% CPU
                 time.sleep(0.005)